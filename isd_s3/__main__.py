@@ -51,6 +51,22 @@ else:
 
 logger = logging.getLogger(__name__)
 
+_sessions = {}
+
+def _get_session(endpoint_url=None, credentials_loc=None):
+    """Returns a Session, reusing one previously created with the same arguments.
+
+    Creating a Session builds a new boto3 client (credential lookup, endpoint
+    resolution, connection pool), so commands run in one process share it.
+    """
+    # Key on the configuration actually in effect (e.g. after
+    # --use_local_config removed the credentials file), not the arguments.
+    config.configure_environment(endpoint_url, credentials_loc, None)
+    session_key = (config.get_s3_url(), config.get_credentials_file())
+    if session_key not in _sessions:
+        _sessions[session_key] = isd_s3.Session(endpoint_url=endpoint_url, credentials_loc=credentials_loc)
+    return _sessions[session_key]
+
 def _get_parser():
     """Creates and returns parser object.
 
@@ -448,7 +464,7 @@ def do_action(args):
         function
     """
     # Init Session
-    session = isd_s3.Session(endpoint_url=args.s3_url, credentials_loc=args.credentials_file)
+    session = _get_session(endpoint_url=args.s3_url, credentials_loc=args.credentials_file)
 
     # Get function corresponding with command
     function = _get_action(session, args.command)
@@ -569,7 +585,7 @@ def call_action_from_dict(args_dict):
         args_dict['s3_url'] = None
     if 'credentials_file' not in args_dict:
         args_dict['credentials_file'] = None
-    session = isd_s3.Session(endpoint_url=args_dict['s3_url'], credentials_loc=args_dict['credentials_file'])
+    session = _get_session(endpoint_url=args_dict['s3_url'], credentials_loc=args_dict['credentials_file'])
 
     # Get function corresponding with command
     function = _get_action(session, args_dict['command'])
@@ -14,11 +14,19 @@ import sys
 import os
 import json
 import re
+import functools
+import itertools
+import time
+import threading
 import boto3
+import botocore.session
 import logging
-import multiprocessing
 
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from s3transfer.utils import ChunksizeAdjuster
 if __package__ is None or __package__ == "":
     import config
 else:
@@ -26,6 +34,89 @@ else:
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CREDENTIALS_FILE = os.path.join('~', '.aws', 'credentials')
+
+MULTIPART_CHUNKSIZE = 1024*1024*8
+MAX_DELETE_KEYS = 1000 # S3 limit for a single delete_objects request
+
+# Largest ThreadPoolExecutor used by a Session.
+MAX_WORKERS = 32
+# Threads each upload_file/download_file/copy call uses for its parts.
+TRANSFER_MAX_CONCURRENCY = 10
+# Size of the client's HTTP connection pool. Every worker in
+# upload_mult_objects and mirror runs a transfer with its own
+# TRANSFER_MAX_CONCURRENCY threads, so this covers both levels.
+# Connections are opened on demand, so an idle pool costs nothing.
+MAX_POOL_CONNECTIONS = MAX_WORKERS * TRANSFER_MAX_CONCURRENCY
+
+BLOCK_SIZE_UNITS = {
+        'KB' : 1000,
+        'MB' : 1000000,
+        'GB' : 1000000000,
+        'TB' : 1000000000000,
+        }
+
+# Shared by uploads and downloads. Large objects are split into
+# MULTIPART_CHUNKSIZE parts which are transferred concurrently.
+_TRANSFER_CFG = TransferConfig(
+        use_threads=True,
+        max_concurrency=TRANSFER_MAX_CONCURRENCY,
+        multipart_threshold=MULTIPART_CHUNKSIZE,
+        multipart_chunksize=MULTIPART_CHUNKSIZE)
+
+# Throttling, 5xx and timeout responses are retried by botocore itself
+# (see Session.get_session). The retries here only cover failures botocore
+# never sees: ETag mismatches after a successful upload, and per-key errors
+# inside a successful delete_objects response.
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1 # seconds, doubled after every failed attempt
+TRANSIENT_ERROR_CODES = ('SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout')
+
+def _backoff(attempt, func_name, reason):
+    """Logs and sleeps before retry number attempt + 1."""
+    delay = RETRY_BASE_DELAY * 2**attempt
+    logger.warning('{} failed ({}). Retrying in {}s'.format(func_name, reason, delay))
+    time.sleep(delay)
+
+def _retry(func):
+    """Retries func with exponential backoff on ETagMismatchException."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except ETagMismatchException as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                _backoff(attempt, func.__name__, e)
+    return wrapper
+
+def _run_bounded(func, args_iter, max_workers):
+    """Calls func(*args) for each args in args_iter on a thread pool.
+
+    At most 2 * max_workers calls are outstanding at once, so args_iter is
+    consumed lazily and a failure is raised as soon as it is seen.
+
+    Args:
+        func (callable): function to call.
+        args_iter (iterable[tuple]): positional arguments for each call.
+        max_workers (int): number of threads.
+
+    Returns:
+        (generator) : (args, result) pairs in completion order.
+    """
+    max_pending = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for args in args_iter:
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(func, *args)] = args
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future.result()
+
 class Session(object):
 
     def __init__(self, endpoint_url=None, credentials_loc=None, default_bucket=None):
@@ -40,15 +131,37 @@ class Session(object):
 
 
         config.configure_environment(endpoint_url, credentials_loc, default_bucket)
-        self.client = self.get_session()
+        # configure_environment sets process-wide variables, so capture
+        # them now; another Session may change them before first use.
+        self._endpoint_url = config.get_s3_url()
+        self._credentials_file = config.get_credentials_file()
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """boto3 client, created on first use.
+
+        Credential lookup and endpoint resolution are deferred until a
+        request is actually made. The lock ensures worker threads share
+        a single client.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.get_session(self._endpoint_url, self._credentials_file)
+        return self._client
 
-    def get_session(self, endpoint_url=None):
+    def get_session(self, endpoint_url=None, credentials_file=None):
         """Gets a boto3 session client.
         This should generally be executed after module load.
 
         Args:
             use_local_cred (bool): Use personal credentials for session. Default False.
             endpoint_url: url to s3. Default https://s3.amazonaws.com/
+            credentials_file (str): location of the credentials file.
+                                    Set explicitly rather than read from
+                                    the environment. (default: ~/.aws/credentials)
 
         Returns:
             (botocore.client.S3): botocore client object
@@ -63,10 +176,21 @@ class Session(object):
             endpoint_url = s3_url
 
 
-        session = boto3.session.Session()
+        client_config = Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+                retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+        if credentials_file is None:
+            credentials_file = DEFAULT_CREDENTIALS_FILE
+        botocore_session = botocore.session.get_session()
+        botocore_session.set_config_variable('credentials_file', credentials_file)
+
+        session = boto3.session.Session(botocore_session=botocore_session)
         return session.client(
                 service_name='s3',
-                endpoint_url=endpoint_url
+                endpoint_url=endpoint_url,
+                config=client_config
                 )
 
     def list_buckets(self, buckets_only=False):
@@ -119,7 +243,7 @@ class Session(object):
 
 
 
-    def disk_usage(bucket=None, prefix="",regex=None,block_size='1MB'):
+    def disk_usage(self, bucket=None, prefix="",regex=None,block_size='1MB'):
         """Returns the disk usage for a set of objects.
 
         Args:
@@ -133,12 +257,93 @@ class Session(object):
         """
         bucket = self.get_bucket(bucket)
 
-        contents = self.list_objects(bucket, prefix, regex=regex)
-        total = 0
         divisor = parse_block_size(block_size)
-        for _object in contents:
-            total += _object['Size'] / divisor
-        return {'disk_usage':total,'units':block_size}
+        if regex is None:
+            # Only sizes are needed, so project them out of each page.
+            # search() yields None for pages without 'Contents'
+            sizes = filter(None, self._paginate(bucket, prefix).search('Contents[].Size'))
+        else:
+            sizes = map(itemgetter('Size'), self.iter_objects(bucket, prefix, regex=regex))
+        total = sum(sizes)
+        return {'disk_usage':total / divisor,'units':block_size}
+
+    def _paginate(self, bucket, prefix="", regex=None):
+        """Gets a list_objects_v2 page iterator.
+
+        Args:
+            bucket (str): Name of s3 bucket.
+            prefix (str): Prefix from which to filter.
+            regex (str): regex string. Only used to narrow the prefix.
+
+        Returns:
+            (botocore.paginate.PageIterator) : pages of objects, or None
+                if prefix and regex can never both match.
+        """
+        if regex is not None:
+            # Let S3 narrow the listing using the regex's literal prefix.
+            # Callers still do the exact match afterwards.
+            literal_prefix = regex_literal_prefix(regex)
+            if literal_prefix.startswith(prefix):
+                prefix = literal_prefix
+            elif not prefix.startswith(literal_prefix):
+                return None
+
+        paginator = self.client.get_paginator('list_objects_v2')
+        return paginator.paginate(
+                Bucket=bucket,
+                Prefix=prefix,
+                PaginationConfig={'PageSize': 1000})
+
+    def iter_objects(self, bucket=None, prefix="", regex=None):
+        """Yields objects from a bucket, optionally matching prefix.
+
+        Objects are yielded page by page, so the full listing is never
+        held in memory.
+
+        Args:
+            bucket (str): Name of s3 bucket.
+            prefix (str): Prefix from which to filter.
+            regex (str): regex string
+
+        Returns:
+            (generator) : objects in given bucket
+        """
+        bucket = self.get_bucket(bucket)
+
+        pages = self._paginate(bucket, prefix, regex)
+        if pages is None:
+            return
+        for page in pages:
+            # Truncated pages may come back without 'Contents'
+            contents = page.get('Contents', [])
+            if regex is not None:
+                contents = self.regex_filter(contents, regex)
+            yield from contents
+
+    def iter_keys(self, bucket=None, prefix="", regex=None):
+        """Yields object keys from a bucket, optionally matching prefix.
+
+        Keys are projected out of each page with JMESPath, so no
+        per-object dicts are kept around.
+
+        Args:
+            bucket (str): Name of s3 bucket.
+            prefix (str): Prefix from which to filter.
+            regex (str): regex string
+
+        Returns:
+            (generator) : keys in given bucket
+        """
+        bucket = self.get_bucket(bucket)
+
+        pages = self._paginate(bucket, prefix, regex)
+        if pages is None:
+            return
+        # search() yields None for pages without 'Contents'
+        keys = filter(None, pages.search('Contents[].Key'))
+        if regex is not None:
+            keys = filter(_compile(regex).match, keys)
+        yield from keys
 
     def list_objects(self, bucket=None, prefix="", ls=False, keys_only=False, regex=None):
         """Lists objects from a bucket, optionally matching _prefix.
@@ -162,24 +367,10 @@ class Session(object):
                 prefix += '/'
             return self.directory_list(bucket, prefix, keys_only)
 
-        contents = []
-
-        response = self.client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        if 'Contents' not in response:
-            return []
-        contents.extend(response['Contents'])
-        while response['IsTruncated']:
-            response = self.client.list_objects_v2(
-                    Bucket=bucket,
-                    Prefix=prefix,
-                    ContinuationToken=response['NextContinuationToken'])
-            contents.extend(response['Contents'])
-        if regex is not None:
-            contents = self.regex_filter(contents, regex)
         if keys_only:
-            return list(map(lambda x: x['Key'], contents))
+            return list(self.iter_keys(bucket, prefix, regex=regex))
 
-        return contents
+        return list(self.iter_objects(bucket, prefix, regex=regex))
 
     def regex_filter(self, contents, regex_str):
         """Filters contents using regular expression.
@@ -192,14 +383,8 @@ class Session(object):
             (list) Contents objects.
 
         """
-        filtered_objects = []
-        regex = re.compile(regex_str)
-        for _object in contents:
-            match = regex.match(_object['Key'])
-            if match is not None:
-                filtered_objects.append(_object)
-
-        return filtered_objects
+        match = _compile(regex_str).match
+        return [_object for _object in contents if match(_object['Key'])]
 
     def get_metadata(self, key, bucket=None):
         """Gets metadata of a given object key.
@@ -227,7 +412,9 @@ class Session(object):
             None
         """
         bucket = self.get_bucket(bucket)
-        return self.copy_object(key, bucket, key, bucket, metadata)
+        if metadata is None:
+            metadata = {} # Copying onto itself requires replacing metadata
+        return self.copy_object(key, key, source_bucket=bucket, dest_bucket=bucket, metadata=metadata)
 
     def move_object(self, source_key, dest_key, source_bucket=None, dest_bucket=None, metadata=None):
         """Moves object to new key. This will overwrite an object the new key already exists.
@@ -243,18 +430,23 @@ class Session(object):
         Returns:
             None
         """
-        self.copy_object(self, source_key, dest_key, source_bucket=None, dest_bucket=None, metadata=None)
-        self.delete([key], bucket=source_bucket)
+        source_bucket = self.get_bucket(source_bucket)
+        self.copy_object(source_key, dest_key, source_bucket=source_bucket, dest_bucket=dest_bucket, metadata=metadata)
+        self.delete([source_key], bucket=source_bucket)
 
     def copy_object(self, source_key, dest_key, source_bucket=None, dest_bucket=None, metadata=None):
         """Copies objects to new key or bucket.
 
+        The copy happens server side. Large objects are copied in
+        MULTIPART_CHUNKSIZE parts concurrently, so objects over 5GB work.
+
         Args:
             source_key (str): key of object to be copied.
             dest_key (str): Name of new s3 object key.
             source_bucket (str): bucket of key
             dest_bucket (str) : Name of s3 bucket.
             metadata (dict, str): dict or string representing key/value pairs.
+                                  Replaces the source metadata if given.
 
         Returns:
             None
@@ -263,22 +455,43 @@ class Session(object):
         if dest_bucket is None:
             dest_bucket = source_bucket
 
-        if metadata is None:
-            return self.client.copy_object(Key=dest_key, Bucket=dest_bucket,
-                    CopySource={"Bucket": source_bucket, "Key": source_key})
-
-        meta_dict = {'Metadata' : None}
-        if isinstance(metadata, str):
-            # Parse string or check if file exists
-             meta_dict['Metadata'] = json.loads(metadata)
-        elif isinstance(metadata, dict):
+        extra_args = None
+        if metadata is not None:
+            if isinstance(metadata, str):
+                metadata = json.loads(metadata)
             #TODO assert it's a flat dict
-            meta_dict['Metadata'] = metadata
+            extra_args = {'Metadata' : metadata, 'MetadataDirective' : 'REPLACE'}
+
+        return self.client.copy({"Bucket": source_bucket, "Key": source_key},
+                dest_bucket, dest_key, ExtraArgs=extra_args, Config=_TRANSFER_CFG)
+
+    def mirror(self, dest_bucket, source_bucket=None, prefix="", regex=None, dry_run=False):
+        """Copies all objects matching prefix to another bucket, keeping their keys.
 
-            return self.client.copy_object(Key=dest_key, Bucket=dest_bucket,
-                    CopySource={"Bucket": source_bucket, "Key": source_key},
-                    Metadata=meta_dict,
-                    MetadataDirective="REPLACE")
+        Objects are copied server side, so no data passes through this host.
+
+        Args:
+            dest_bucket (str) [REQUIRED]: Name of destination s3 bucket.
+            source_bucket (str): Name of source s3 bucket.
+            prefix (str): Prefix from which to filter.
+            regex (str): regex string
+            dry_run (bool): Print copy commands only.  No action taken if True.
+
+        Returns:
+            None
+        """
+        source_bucket = self.get_bucket(source_bucket)
+
+        keys = self.iter_keys(source_bucket, prefix, regex=regex)
+        if dry_run:
+            for key in keys:
+                print('(Dry Run) Copying :'+source_bucket+'/'+key+" to "+dest_bucket+'/'+key)
+            return
+
+        def copy(key):
+            return self.copy_object(key, key, source_bucket=source_bucket, dest_bucket=dest_bucket)
+        for _ in _run_bounded(copy, ((key,) for key in keys), MAX_WORKERS):
+            pass
 
     def add_required_metadata(self, _dict):
         """Adds required metadata to dict.
@@ -318,49 +531,53 @@ class Session(object):
         #if metadata is None:
         #    return self.client.upload_file(local_file, bucket, key)
 
-        meta_dict = {'Metadata' : {}}
         if isinstance(metadata, str):
             # Parse string or check if file exists
             try:
-                meta_dict['Metadata'] = json.loads(metadata)
-            except:
-                pass
-        elif isinstance(metadata, dict):
-            #TODO assert it's a flat dict
-            meta_dict['Metadata'] = metadata
-        self.add_required_metadata(meta_dict['Metadata'])
+                metadata = json.loads(metadata)
+            except ValueError:
+                metadata = None
+        #TODO assert it's a flat dict
+        # Copy, since upload_mult_objects shares one dict across threads
+        metadata = dict(metadata) if metadata else {}
+        self.add_required_metadata(metadata)
 
         if md5:
-            meta_dict['Metadata']['Content-MD5'] = get_md5sum(local_file)
+            metadata['Content-MD5'] = get_md5sum(local_file)
             #meta_dict['ContentMD5'] = get_md5sum(local_file)
-        trans_config = TransferConfig(
-                use_threads=True,
-                max_concurrency=10,
-                multipart_threshold=1024*1024*25,
-                multipart_chunksize=1024*1024*25)
-
-        success = False
-        etag = calculate_s3_etag(local_file)
-        retry = 0
-        max_retries = 4
-        while not success and retry < max_retries:
-            ret = self.client.upload_file(local_file, bucket, key, ExtraArgs=meta_dict, Config=trans_config)
-            if verify:
-                meta = self.get_metadata(key, bucket=bucket)
-                print(etag)
-                print(meta['ETag'])
-                if etag == meta['ETag']:
-                    success = True
-                else:
-                    retry += 1
-                    logging.info('Etag doesn\'t match. Retrying')
-        if retry == max_retries:
-            raise ISD_S3_Exception('ETag verification failed on upload')
+        meta_dict = {'Metadata' : metadata}
+
+        etag = None
+        if verify:
+            etag = calculate_s3_etag(local_file)
+        return self._upload_file(local_file, key, bucket, meta_dict, etag)
+
+    @_retry
+    def _upload_file(self, local_file, key, bucket, extra_args, etag=None):
+        """Uploads a single file, optionally verifying its ETag.
+
+        Args:
+            local_file (str): Filename of local file.
+            key (str): Name of s3 object key.
+            bucket (str) : Name of s3 bucket.
+            extra_args (dict): ExtraArgs passed to upload_file.
+            etag (str): Expected ETag of the uploaded object. Not verified if None.
 
+        Returns:
+            None
+        """
+        ret = self.client.upload_file(local_file, bucket, key, ExtraArgs=extra_args, Config=_TRANSFER_CFG)
+        if etag is not None:
+            meta = self.get_metadata(key, bucket=bucket)
+            logger.debug('local ETag: {}, remote ETag: {}'.format(etag, meta['ETag']))
+            if etag != meta['ETag']:
+                raise ETagMismatchException('ETag verification failed on upload of ' + key)
         return ret
 
     def get_filelist(self, local_dir, recursive=False, ignore=[]):
-        """Returns local filelist as a list of (fullpath, localpath) pairs.
+        """Yields local files as (fullpath, localpath) pairs.
+
+        localpath is the path relative to local_dir.
 
         Args:
             local_dir (str) [REQUIRED]: local directory to scan
@@ -368,22 +585,19 @@ class Session(object):
                               Does not follow symlinks.
             ignore (iterable[str]): strings to ignore.
         """
+        ignore = list(ignore)
+        ignore_regex = None
+        if len(ignore) > 0:
+            ignore_regex = re.compile('|'.join(map(re.escape, ignore)))
 
-        filelist = []
-        for root,_dir,files in os.walk(local_dir, topdown=True):
-            for _file in files:
-                full_filename = os.path.join(root,_file)
-
-                ignore_cur_file=False
-                for ignore_str in ignore:
-                    if ignore_str in full_filename:
-                        ignore_cur_file=True
-                        break
-                if not ignore_cur_file:
-                    filelist.append((full_filename, _file))
-            if not recursive:
-                return filelist
-        return filelist
+        # Every path from _walk starts with local_dir and a separator,
+        # so slicing gives the relative path without calling relpath.
+        local_dir = os.path.normpath(local_dir)
+        local_dir_len = len(os.path.join(local_dir, ''))
+
+        for entry in _walk(local_dir, recursive):
+            if ignore_regex is None or ignore_regex.search(entry.path) is None:
+                yield (entry.path, entry.path[local_dir_len:])
 
     def upload_mult_objects(self, local_dir, key_prefix=None, bucket=None, recursive=False, ignore=[], metadata=None, dry_run=False):
         """Uploads files within a directory.
@@ -409,29 +623,33 @@ class Session(object):
 
         """
         bucket = self.get_bucket(bucket)
+        if key_prefix is None:
+            key_prefix = ""
 
         filelist = self.get_filelist(local_dir=local_dir, recursive=recursive, ignore=ignore)
         if metadata is not None:
-            func = self._interpret_metadata_str(metadata)
-        cpus = multiprocessing.cpu_count()
-        for (_file, localPath) in filelist:
-            key = key_prefix + localPath
-
-            metadata_str = None
-            print(_file)
-            if metadata is not None:
-                metadata_str = func(_file)
-
-            if dry_run:
-                print('(Dry Run) Uploading :'+_file+" to "+bucket+'/'+key)
-            else:
-                try:
-                    p = multiprocessing.Process(
-                            target=self.upload_object,
-                            args=(_file, key, metadata_str, bucket ))
-                    p.start()
-                except:
-                    self.upload_object(_file, key, metadata, bucket)
+            func = self.interpret_metadata_str(metadata)
+        def upload_args():
+            for (_file, localPath) in filelist:
+                if os.sep != '/':
+                    localPath = localPath.replace(os.sep, '/')
+                key = f"{key_prefix}{localPath}"
+
+                metadata_str = None
+                print(_file)
+                if metadata is not None:
+                    metadata_str = func(_file)
+
+                if dry_run:
+                    print(f"(Dry Run) Uploading :{_file} to {bucket}/{key}")
+                else:
+                    yield (_file, key, metadata_str, bucket)
+
+        # Uploads are network bound, so threads sharing self.client are
+        # sufficient. boto3 low-level clients are thread-safe.
+        cpus = os.cpu_count() or 1
+        for _ in _run_bounded(self.upload_object, upload_args(), min(MAX_WORKERS, 4*cpus)):
+            pass
 
 
     def interpret_metadata_str(self, metadata):
@@ -447,6 +665,8 @@ class Session(object):
         # Check if json
         try:
             metadata_obj = json.loads(metadata)
+            # Fill required fields once rather than for every file
+            self.add_required_metadata(metadata_obj)
             return lambda x: metadata_obj
         # Otherwise, it should be a script
         except ValueError:
@@ -473,12 +693,14 @@ class Session(object):
         if local_filename is None:
             local_filename = os.path.basename(key)
         os.path.join(local_dir, local_filename)
-        self.client.download_file(bucket, key, local_filename)
+        self.client.download_file(bucket, key, local_filename, Config=_TRANSFER_CFG)
         return {'result' : 'successful'}
 
     def delete(self, keys=[], bucket=None, dry_run=False):
         """Deletes Key from given bucket.
 
+        Keys are deleted in batches of up to MAX_DELETE_KEYS per request.
+
         Args:
             key (str) [REQUIRED]: Name of s3 object key.
             dry_run (bool): Print delete command as a sanity check.  No action taken if True.
@@ -490,11 +712,50 @@ class Session(object):
             keys=[keys]
         assert len(keys) > 0
         bucket = self.get_bucket(bucket)
-        for key in keys:
-            if dry_run:
-                logging.info('deleting ' + k)
-            else:
-                self.client.delete_object(Bucket=bucket, Key=key)
+        if dry_run:
+            for key in keys:
+                logging.info('deleting ' + key)
+            return
+
+        keys = iter(keys)
+        chunks = iter(lambda: list(itertools.islice(keys, MAX_DELETE_KEYS)), [])
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(self._delete_chunk, chunk, bucket) for chunk in chunks]
+            for future in as_completed(futures):
+                future.result()
+
+    def _delete_chunk(self, keys, bucket):
+        """Deletes up to MAX_DELETE_KEYS keys in a single request.
+
+        Keys that fail with a transient error are retried with backoff.
+
+        Args:
+            keys (list) : keys to delete.
+            bucket (str) : Name of s3 bucket.
+
+        Returns:
+            None
+        """
+        for attempt in range(MAX_RETRIES):
+            response = self.client.delete_objects(
+                    Bucket=bucket,
+                    Delete={
+                        'Objects' : [{'Key' : key} for key in keys],
+                        'Quiet' : True})
+            errors = response.get('Errors', [])
+            if len(errors) == 0:
+                return
+
+            permanent = [e for e in errors if e['Code'] not in TRANSIENT_ERROR_CODES]
+            if len(permanent) > 0 or attempt == MAX_RETRIES - 1:
+                errors = permanent or errors
+                error_msg = 'Failed to delete ' + str(len(errors)) + ' objects. ' + \
+                        'First error: ' + errors[0]['Key'] + ': ' + errors[0]['Code']
+                logger.error(error_msg)
+                raise ISD_S3_Exception(error_msg)
+
+            keys = [e['Key'] for e in errors]
+            _backoff(attempt, '_delete_chunk', str(len(keys)) + ' keys, ' + errors[0]['Code'])
 
     def delete_mult(self, bucket=None, obj_regex=None, dry_run=False, prefix=""):
         """delete objects where keys match regex.
@@ -503,8 +764,9 @@ class Session(object):
             bucket (str) : Name of s3 bucket.
         """
         bucket = self.get_bucket(bucket)
-        all_keys = self.list_objects(bucket=bucket, regex=obj_regex, keys_only=True, prefix="")
-        matching_keys = []
+        all_keys = self.list_objects(bucket=bucket, regex=obj_regex, keys_only=True, prefix=prefix)
+        if len(all_keys) == 0:
+            return
         self.delete(bucket=bucket, keys=all_keys, dry_run=dry_run)
 
     def search_metadata(self, bucket=None, obj_regex=None, metadata_key=None):
@@ -520,13 +782,18 @@ class Session(object):
         """
         bucket = self.get_bucket(bucket)
 
-        all_keys = self.list_objects(bucket, regex=obj_regex, keys_only=True)
+        def get_metadata(key):
+            return self.get_metadata(key, bucket=bucket)['Metadata']
+
+        all_keys = self.iter_keys(bucket, regex=obj_regex)
         matching_keys = []
-        for key in all_keys:
-            return_dict = self.get_metadata(bucket, key)
-            if metadata_key in return_dict.keys():
+        # head_object is one round trip per key, so fan out across threads
+        for (key,), metadata in _run_bounded(get_metadata, ((key,) for key in all_keys), MAX_WORKERS):
+            if metadata_key in metadata:
                 matching_keys.append(key)
 
+        # Results arrive in completion order; S3 lists keys sorted
+        matching_keys.sort()
         return matching_keys
 
     def __str__(self):
@@ -536,6 +803,31 @@ class Session(object):
                 "default bucket: " + str(config.get_default_bucket())
 
 
+def _walk(local_dir, recursive=False):
+    """Yields os.DirEntry objects for files under local_dir.
+
+    Symlinks to directories are treated like os.walk treats them: never
+    descended into, and not yielded as files. Subdirectories that can't
+    be read are logged and skipped, as os.walk does.
+    """
+    stack = [local_dir]
+    while len(stack) > 0:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            if directory == local_dir:
+                raise
+            logger.warning('Skipping directory {}: {}'.format(directory, e))
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive and not entry.is_symlink():
+                        stack.append(entry.path)
+                else:
+                    yield entry
+
 def exit_session(error):
     """Throw error or exit.
 
@@ -556,43 +848,74 @@ def parse_block_size(block_size_str):
     Example:
         '1MB' yields 1000000
 
+    Raises:
+        ValueError: if block_size_str is not a number followed by a unit.
+    """
+    match = _compile(r'^(\d+)(KB|MB|GB|TB)$').match(block_size_str.upper())
+    if match is None:
+        raise ValueError('Unrecognized block size "' + block_size_str + \
+                '". Expected a number followed by one of ' + ', '.join(BLOCK_SIZE_UNITS))
+    number, unit = match.groups()
+    return int(number) * BLOCK_SIZE_UNITS[unit]
+
+@functools.lru_cache(maxsize=256)
+def _compile(regex_str):
+    """Compiles regex_str, caching the result for repeated calls."""
+    return re.compile(regex_str)
+
+def regex_literal_prefix(regex_str):
+    """Gets the literal string every match of regex_str must start with.
+
+    Example:
+        '^mydataset/2021/.*\\.nc$' yields 'mydataset/2021/'
+
+    Args:
+        regex_str (str): regular expression string, matched from the
+                         start of the key.
+
+    Returns:
+        (str) literal prefix. Empty string if none can be determined.
+    """
+    if '|' in regex_str:
+        # Alternation means there's no single common prefix
+        return ''
+    if regex_str.startswith('^'):
+        regex_str = regex_str[1:]
+
+    special_chars = '.^$*+?{[|()\\'
+    literal = ''
+    for i, char in enumerate(regex_str):
+        if char in special_chars:
+            # A quantifier makes the preceding character optional
+            if char in '*?{' and len(literal) > 0:
+                literal = literal[:-1]
+            break
+        literal += char
+    return literal
+
+def calculate_s3_etag(file_path, transfer_config=_TRANSFER_CFG):
+    """Computes the ETag S3 will report for file_path uploaded with transfer_config.
+
+    Files smaller than the multipart threshold are uploaded in one PUT and
+    get a plain md5. Anything else is multipart, even if it fits in one part.
     """
-    units = {
-            'KB' : 1000,
-            'MB' : 1000000,
-            'GB' : 1000000000,
-            'TB' : 1000000000000,
-            }
-    if len(block_size_str) < 3:
-        print('block_size doesn\'t have enough information')
-        print('defaulting to 1KB')
-        block_size_str = '1KB'
-    unit = block_size_str[-2:].upper()
-    number = int(block_size_str[:-2])
-    if unit not in units:
-        print('unrecognized unit.')
-        print('defaulting to 1KB')
-        unit = 'KB'
-        number = 1
-
-    base_divisor = units[unit]
-    divisor = base_divisor * number
-    return divisor
-
-def calculate_s3_etag(file_path, chunk_size=1024*1024*25):
     import hashlib
+    file_size = os.path.getsize(file_path)
+    if file_size < transfer_config.multipart_threshold:
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as fp:
+            for data in iter(lambda: fp.read(MULTIPART_CHUNKSIZE), b''):
+                md5.update(data)
+        return '"{}"'.format(md5.hexdigest())
+
+    # s3transfer grows the part size to stay within S3's part limits
+    chunk_size = ChunksizeAdjuster().adjust_chunksize(
+            transfer_config.multipart_chunksize, file_size)
     md5s = []
-
     with open(file_path, 'rb') as fp:
-        while True:
-            data = fp.read(chunk_size)
-            if not data:
-                break
+        for data in iter(lambda: fp.read(chunk_size), b''):
             md5s.append(hashlib.md5(data))
 
-    if len(md5s) == 1:
-        return '"{}"'.format(md5s[0].hexdigest())
-
     digests = b''.join(m.digest() for m in md5s)
     digests_md5 = hashlib.md5(digests)
     return '"{}-{}"'.format(digests_md5.hexdigest(), len(md5s))
@@ -605,3 +928,6 @@ def get_md5sum(local_file):
 class ISD_S3_Exception(Exception):
     pass
 
+class ETagMismatchException(ISD_S3_Exception):
+    pass
+
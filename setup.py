@@ -3,11 +3,11 @@ from setuptools import find_packages, setup
 
 import isd_s3
 
-if sys.version_info < (3, 1):
+if sys.version_info < (3, 6):
     raise NotImplementedError(
         """\n
 ##############################################################
-# isd-s3 does not support python versions older than 3.1 #
+# isd-s3 does not support python versions older than 3.6 #
 ##############################################################"""
     )
 
@@ -33,13 +33,11 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: POSIX",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Topic :: Software Development :: Libraries :: Python Modules",
         "Intended Audience :: Developers"
     ],
-    python_requires='>=3.1',
+    python_requires='>=3.6',
     entry_points={"console_scripts": ["isd_s3=isd_s3.__main__:main"]}
 )
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Unit tests for isd_s3.py that don't need a live bucket.
+"""
+import os
+import sys
+import hashlib
+import threading
+import pytest
+from boto3.s3.transfer import TransferConfig
+from botocore.stub import Stubber
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+'/..')
+from isd_s3 import isd_s3
+from isd_s3 import config
+from isd_s3 import __main__ as main
+
+bucket = 'test-bucket'
+
+
+@pytest.fixture
+def session(monkeypatch):
+    # Session sets these process-wide; monkeypatch restores them afterwards.
+    monkeypatch.setenv(config.S3_URL, 'https://s3.example.com')
+    monkeypatch.setenv(config.ISD_S3_DEFAULT_BUCKET, bucket)
+    monkeypatch.setenv(config.AWS_SHARED_CREDENTIALS_FILE, os.devnull)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr(isd_s3, 'RETRY_BASE_DELAY', 0)
+    return isd_s3.Session(endpoint_url='https://s3.example.com')
+
+@pytest.fixture
+def stubber(session):
+    with Stubber(session.client) as stub:
+        yield stub
+        stub.assert_no_pending_responses()
+
+def list_params(prefix):
+    return {'Bucket' : bucket, 'Prefix' : prefix, 'MaxKeys' : 1000}
+
+def list_response(keys):
+    return {
+            'IsTruncated' : False,
+            'KeyCount' : len(keys),
+            'Contents' : [{'Key' : key, 'Size' : 10} for key in keys]}
+
+
+def test_regex_literal_prefix():
+    assert isd_s3.regex_literal_prefix(r'^mydataset/2021/.*\.nc$') == 'mydataset/2021/'
+    assert isd_s3.regex_literal_prefix('mydataset/2021') == 'mydataset/2021'
+    assert isd_s3.regex_literal_prefix('^') == ''
+    # Quantifiers make the preceding character optional
+    assert isd_s3.regex_literal_prefix('abc*') == 'ab'
+    assert isd_s3.regex_literal_prefix('abc?') == 'ab'
+    assert isd_s3.regex_literal_prefix('abc{0,2}') == 'ab'
+    assert isd_s3.regex_literal_prefix('abc+') == 'abc'
+    # Alternation has no common prefix
+    assert isd_s3.regex_literal_prefix('abc|abd') == ''
+    assert isd_s3.regex_literal_prefix('ab(c|d)') == ''
+    # Groups, classes and escapes stop the literal run
+    assert isd_s3.regex_literal_prefix('(?i)abc') == ''
+    assert isd_s3.regex_literal_prefix('ab[cd]') == 'ab'
+    assert isd_s3.regex_literal_prefix(r'ds\d') == 'ds'
+
+def test_paginate_narrows_prefix(session, stubber):
+    stubber.add_response('list_objects_v2',
+            list_response(['data/2021/a.nc', 'data/2021/b.txt']),
+            list_params('data/2021/'))
+    keys = list(session.iter_keys(bucket, 'data/', regex=r'^data/2021/.*\.nc$'))
+    assert keys == ['data/2021/a.nc']
+
+def test_paginate_keeps_longer_prefix(session, stubber):
+    stubber.add_response('list_objects_v2',
+            list_response(['data/2021/a.nc']),
+            list_params('data/2021/'))
+    keys = list(session.iter_keys(bucket, 'data/2021/', regex='^data/'))
+    assert keys == ['data/2021/a.nc']
+
+def test_paginate_conflict(session, stubber):
+    # No request is stubbed, so any listing would fail
+    assert list(session.iter_keys(bucket, 'data/', regex='^other/')) == []
+    assert list(session.iter_objects(bucket, 'data/', regex='^other/')) == []
+
+def test_calculate_s3_etag(tmp_path):
+    transfer_config = TransferConfig(multipart_threshold=1024, multipart_chunksize=1024)
+    local_file = str(tmp_path / 'file')
+    def etag(data):
+        with open(local_file, 'wb') as fh:
+            fh.write(data)
+        return isd_s3.calculate_s3_etag(local_file, transfer_config)
+
+    assert etag(b'') == '"{}"'.format(hashlib.md5(b'').hexdigest())
+    assert etag(b'a'*1023) == '"{}"'.format(hashlib.md5(b'a'*1023).hexdigest())
+    # At the threshold the upload is multipart, even with a single part
+    part_md5 = hashlib.md5(b'a'*1024).digest()
+    assert etag(b'a'*1024) == '"{}-1"'.format(hashlib.md5(part_md5).hexdigest())
+    # s3transfer raises parts to S3's 5MB minimum, so this is still one part
+    assert etag(b'a'*1025).endswith('-1"')
+
+def test_delete_chunking(session, stubber):
+    chunk_sizes = []
+    def record_chunk(params, **kwargs):
+        chunk_sizes.append(len(params['Delete']['Objects']))
+    session.client.meta.events.register('provide-client-params.s3.DeleteObjects', record_chunk)
+
+    keys = ['key' + str(i) for i in range(2500)]
+    for _ in range(3):
+        stubber.add_response('delete_objects', {})
+    session.delete(keys)
+    assert sorted(chunk_sizes) == [500, 1000, 1000]
+
+def test_delete_permanent_error(session, stubber):
+    stubber.add_response('delete_objects',
+            {'Errors' : [{'Key' : 'a', 'Code' : 'AccessDenied', 'Message' : ''}]})
+    with pytest.raises(isd_s3.ISD_S3_Exception):
+        session.delete(['a'])
+
+def test_get_filelist_walk(session, tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'x.txt').write_text('x')
+    (tmp_path / 'a' / 'y.txt').write_text('y')
+    (tmp_path / 'a' / 'b' / 'z.tmp').write_text('z')
+    # Like os.walk, symlinked directories are neither followed nor yielded
+    (tmp_path / 'link').symlink_to(tmp_path / 'a')
+
+    def fullpaths(filelist):
+        return sorted(os.path.relpath(fullpath, str(tmp_path)) for (fullpath, _) in filelist)
+
+    filelist = session.get_filelist(str(tmp_path), recursive=True)
+    assert fullpaths(filelist) == ['a/b/z.tmp', 'a/y.txt', 'x.txt']
+
+    filelist = session.get_filelist(str(tmp_path))
+    assert fullpaths(filelist) == ['x.txt']
+
+    # ignore may be any iterable, including a generator
+    filelist = session.get_filelist(str(tmp_path), recursive=True, ignore=iter(['.tmp']))
+    assert fullpaths(filelist) == ['a/y.txt', 'x.txt']
+
+def test_parse_block_size():
+    assert isd_s3.parse_block_size('1MB') == 1000000
+    assert isd_s3.parse_block_size('500kb') == 500000
+    for bad in ['', 'MB', '1', '1XB', '1.5GB', '-1MB', 'MB1']:
+        with pytest.raises(ValueError):
+            isd_s3.parse_block_size(bad)
+
+def test_upload_mult_objects_keys(session, tmp_path, monkeypatch):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'x.txt').write_text('x')
+    (tmp_path / 'a' / 'y.txt').write_text('y')
+    uploaded = {}
+    def upload_object(local_file, key, metadata=None, bucket=None):
+        uploaded[key] = local_file
+    monkeypatch.setattr(session, 'upload_object', upload_object)
+
+    # Keys are relative to local_dir, however local_dir is spelled
+    session.upload_mult_objects(str(tmp_path) + os.sep, key_prefix='ds/', recursive=True)
+    assert uploaded == {
+            'ds/x.txt' : str(tmp_path / 'x.txt'),
+            'ds/a/y.txt' : str(tmp_path / 'a' / 'y.txt')}
+
+    uploaded.clear()
+    session.upload_mult_objects(str(tmp_path))
+    assert list(uploaded) == ['x.txt']
+
+def test_run_bounded_window():
+    release = threading.Event()
+    pulled = []
+    def args_iter():
+        for i in range(20):
+            pulled.append(i)
+            yield (i,)
+    def func(i):
+        release.wait(5)
+        return i * 2
+
+    results = []
+    worker = threading.Thread(target=lambda: results.extend(isd_s3._run_bounded(func, args_iter(), 2)))
+    worker.start()
+    # With every call blocked, only 2 * max_workers may be submitted
+    # (plus the one waiting for a free slot).
+    release.wait(0.2)
+    assert len(pulled) <= 5
+    release.set()
+    worker.join(5)
+    assert sorted(results) == [((i,), i * 2) for i in range(20)]
+
+def test_upload_mult_objects_raises(session, tmp_path, monkeypatch):
+    for i in range(10):
+        (tmp_path / (str(i) + '.txt')).write_text('x')
+    def upload_object(local_file, key, metadata=None, bucket=None):
+        raise isd_s3.ISD_S3_Exception('upload failed')
+    monkeypatch.setattr(session, 'upload_object', upload_object)
+    with pytest.raises(isd_s3.ISD_S3_Exception):
+        session.upload_mult_objects(str(tmp_path))
+
+def test_search_metadata(session, stubber, monkeypatch):
+    keys = ['k' + str(i).zfill(3) for i in range(200)]
+    stubber.add_response('list_objects_v2', list_response(keys), list_params(''))
+    def get_metadata(key, bucket=None):
+        assert bucket == globals()['bucket']
+        return {'Metadata' : {'tag' : 'x'} if int(key[1:]) % 3 == 0 else {}}
+    monkeypatch.setattr(session, 'get_metadata', get_metadata)
+
+    assert session.search_metadata(metadata_key='tag') == keys[::3]
+
+def test_delete_retries_transient_keys(session, stubber):
+    stubber.add_response('delete_objects',
+            {'Errors' : [{'Key' : 'b', 'Code' : 'SlowDown', 'Message' : ''}]},
+            {'Bucket' : bucket, 'Delete' : {
+                'Objects' : [{'Key' : 'a'}, {'Key' : 'b'}], 'Quiet' : True}})
+    stubber.add_response('delete_objects', {},
+            {'Bucket' : bucket, 'Delete' : {
+                'Objects' : [{'Key' : 'b'}], 'Quiet' : True}})
+    session.delete(['a', 'b'])
+
+def test_retry_only_etag_mismatch(monkeypatch):
+    monkeypatch.setattr(isd_s3, 'RETRY_BASE_DELAY', 0)
+    calls = []
+    @isd_s3._retry
+    def fail(exception):
+        calls.append(exception)
+        raise exception('failed')
+
+    with pytest.raises(isd_s3.ETagMismatchException):
+        fail(isd_s3.ETagMismatchException)
+    assert len(calls) == isd_s3.MAX_RETRIES
+
+    # Anything else has already been retried by botocore, or is permanent
+    calls.clear()
+    with pytest.raises(isd_s3.ISD_S3_Exception):
+        fail(isd_s3.ISD_S3_Exception)
+    assert len(calls) == 1
+
+def test_upload_object_etag_retry(session, stubber, tmp_path):
+    local_file = tmp_path / 'file'
+    local_file.write_bytes(b'data')
+    etag = isd_s3.calculate_s3_etag(str(local_file))
+    stubber.add_response('put_object', {})
+    stubber.add_response('head_object', {'ETag' : '"wrong"'}, {'Bucket' : bucket, 'Key' : 'key'})
+    stubber.add_response('put_object', {})
+    stubber.add_response('head_object', {'ETag' : etag}, {'Bucket' : bucket, 'Key' : 'key'})
+    session.upload_object(str(local_file), 'key')
+
+def test_main_session_cache(session, monkeypatch):
+    monkeypatch.setattr(main, '_sessions', {})
+    creds = os.path.join(os.sep, 'x', 'creds')
+
+    session_a = main._get_session(credentials_loc=creds)
+    assert session_a._credentials_file == creds
+    # The credentials file is still set in the environment
+    assert main._get_session() is session_a
+
+    # As done by --use_local_config
+    monkeypatch.delenv(config.AWS_SHARED_CREDENTIALS_FILE)
+    session_b = main._get_session()
+    assert session_b is not session_a
+    assert session_b._credentials_file is None
+
+    session_c = main._get_session(endpoint_url='https://other.example.com')
+    assert session_c not in (session_a, session_b)
+
+def test_lazy_client(session):
+    assert session._client is None
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(session.client)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(clients) == 8
+    assert all(client is clients[0] for client in clients)
+
+def test_client_pins_credentials(session, tmp_path, monkeypatch):
+    # Let the credentials file, not the environment, provide credentials
+    monkeypatch.delenv('AWS_ACCESS_KEY_ID')
+    monkeypatch.delenv('AWS_SECRET_ACCESS_KEY')
+    for name in ['a', 'b']:
+        (tmp_path / name).write_text('[default]\naws_access_key_id = ' + name.upper()*3 + \
+                '\naws_secret_access_key = ' + name + '\n')
+
+    # Neither client exists until both Sessions have set the environment
+    session_a = isd_s3.Session(endpoint_url='https://a.example.com', credentials_loc=str(tmp_path / 'a'))
+    session_b = isd_s3.Session(endpoint_url='https://b.example.com', credentials_loc=str(tmp_path / 'b'))
+    for (_session, url, access_key) in [
+            (session_a, 'https://a.example.com', 'AAA'),
+            (session_b, 'https://b.example.com', 'BBB')]:
+        assert _session.client.meta.endpoint_url == url
+        assert _session.client._request_signer._credentials.access_key == access_key
+
+def test_copy_object(session, stubber):
+    # Managed copy checks the source size, then copies server side
+    stubber.add_response('head_object', {'ContentLength' : 10},
+            {'Bucket' : bucket, 'Key' : 'src'})
+    stubber.add_response('copy_object', {}, {
+            'Bucket' : 'dest-bucket',
+            'Key' : 'dest',
+            'CopySource' : {'Bucket' : bucket, 'Key' : 'src'},
+            'Metadata' : {'a' : '1'},
+            'MetadataDirective' : 'REPLACE'})
+    session.copy_object('src', 'dest', dest_bucket='dest-bucket', metadata='{"a": "1"}')
+
+def test_mirror(session, stubber, monkeypatch):
+    keys = ['data/' + str(i) for i in range(100)]
+    stubber.add_response('list_objects_v2', list_response(keys), list_params('data/'))
+    copied = []
+    def copy_object(source_key, dest_key, source_bucket=None, dest_bucket=None, metadata=None):
+        assert (source_bucket, dest_bucket) == (bucket, 'dest-bucket')
+        copied.append(dest_key)
+    monkeypatch.setattr(session, 'copy_object', copy_object)
+
+    session.mirror('dest-bucket', prefix='data/')
+    assert sorted(copied) == sorted(keys)
+
+def test_mirror_raises(session, stubber, monkeypatch):
+    stubber.add_response('list_objects_v2', list_response(['a', 'b']), list_params(''))
+    def copy_object(*args, **kwargs):
+        raise isd_s3.ISD_S3_Exception('copy failed')
+    monkeypatch.setattr(session, 'copy_object', copy_object)
+    with pytest.raises(isd_s3.ISD_S3_Exception):
+        session.mirror('dest-bucket')
+
+def test_disk_usage(session, stubber):
+    stubber.add_response('list_objects_v2', list_response(['a', 'b', 'c']), list_params(''))
+    assert session.disk_usage(block_size='1KB') == {'disk_usage' : 0.03, 'units' : '1KB'}
+
+    # With a regex, sizes come from the filtered objects
+    stubber.add_response('list_objects_v2', list_response(['ab', 'ac', 'bc']), list_params('a'))
+    assert session.disk_usage(regex='a.', block_size='1KB') == {'disk_usage' : 0.02, 'units' : '1KB'}